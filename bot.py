@@ -5,32 +5,64 @@ Complete Arabic Telegram Bot with Reply Keyboard Menu
 
 import logging
 import asyncio
+import bisect
+import queue
 import sqlite3
-import datetime
 import random
-import string
-import hashlib
-import re
-from typing import Dict, List, Optional, Tuple
-from dataclasses import dataclass
+import functools
+import secrets
+import threading
+import time
+from datetime import datetime, timezone
+from types import MappingProxyType
+from typing import Dict, Iterator, List, Optional
 from enum import Enum
+from collections import OrderedDict, defaultdict
+from concurrent.futures import ThreadPoolExecutor
 from contextlib import contextmanager
 
 from telegram import (
-    Update, InlineKeyboardButton, InlineKeyboardMarkup, 
-    ReplyKeyboardMarkup, ReplyKeyboardRemove, KeyboardButton,
-    Bot, WebAppInfo
+    Bot, Message, Update, InlineKeyboardButton, InlineKeyboardMarkup, 
+    ReplyKeyboardMarkup, ReplyKeyboardRemove
 )
 from telegram.ext import (
     Application, CommandHandler, CallbackQueryHandler, 
-    MessageHandler, ConversationHandler, ContextTypes, filters
+    MessageHandler, ContextTypes, filters
 )
 from telegram.constants import ParseMode
+from telegram.error import RetryAfter, TelegramError
 
 # Configuration
 BOT_TOKEN = "توكن البوت"
 ADMIN_IDS = [ايدي المستخدم ]  # Replace with actual admin Telegram IDs
 DATABASE_NAME = "bot_database.db"
+DB_POOL_SIZE = 4
+# Prepared statements cached per connection, keyed by SQL text
+DB_STATEMENT_CACHE_SIZE = 256
+SETTINGS_CACHE_TTL = 300  # seconds
+USER_CACHE_TTL = 30  # seconds
+LEADERBOARD_CACHE_TTL = 60  # seconds
+PRODUCTS_CACHE_TTL = 300  # seconds
+ACTIVITY_FLUSH_INTERVAL = 10  # seconds
+POINTS_FLUSH_INTERVAL = 1  # seconds
+POINTS_FLUSH_BATCH = 500  # rows per write transaction
+TELEGRAM_POOL_SIZE = 64  # concurrent HTTPS connections to the Bot API
+BROADCAST_RATE_LIMIT = 25  # messages sent per second during a broadcast
+BROADCAST_WORKERS = 20
+BROADCAST_MAX_RETRIES = 3
+BROADCAST_PROGRESS_EVERY = 100  # sends between status message updates
+MESSAGE_MAX_LENGTH = 4096  # Telegram limit for a single text message
+
+# Applied to every pooled connection when it is opened
+# (journal_mode is persistent and set once in init_database)
+SQLITE_PRAGMAS = (
+    'PRAGMA synchronous=NORMAL',
+    'PRAGMA wal_autocheckpoint=1000',
+    'PRAGMA busy_timeout=5000',
+    'PRAGMA temp_store=MEMORY',
+    'PRAGMA cache_size=-65536',  # 64 MiB page cache per connection
+    'PRAGMA mmap_size=268435456',
+)
 
 # States
 class States(Enum):
@@ -58,17 +90,155 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+# ==================== CACHING ====================
+
+class TTLCache:
+    """Bounded LRU cache whose entries expire after `ttl` seconds
+    
+    Read-through callers should reserve() a key before querying and fill()
+    it afterwards: a pop() in between cancels the fill, so a row read before
+    a concurrent write cannot be cached after that write's eviction.
+    """
+    
+    def __init__(self, maxsize: int, ttl: float):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._filling = {}
+        self._lock = threading.Lock()
+    
+    def get(self, key, default=None):
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                return default
+            expires, value = item
+            if expires < time.monotonic():
+                del self._data[key]
+                return default
+            self._data.move_to_end(key)
+            return value
+    
+    def set(self, key, value):
+        with self._lock:
+            self._store(key, value)
+    
+    def _store(self, key, value):
+        self._data[key] = (time.monotonic() + self.ttl, value)
+        self._data.move_to_end(key)
+        if len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+    
+    def reserve(self, key) -> object:
+        """Start a read-through fill of key, returns the token for fill()"""
+        token = object()
+        with self._lock:
+            self._filling[key] = token
+        return token
+    
+    def fill(self, key, token: object, value):
+        """Store value unless key was popped or re-reserved since reserve()
+        
+        A None value only releases the reservation.
+        """
+        with self._lock:
+            if self._filling.get(key) is not token:
+                return
+            del self._filling[key]
+            if value is not None:
+                self._store(key, value)
+    
+    def pop(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+            self._filling.pop(key, None)
+    
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self._filling.clear()
+
+# ==================== RATE LIMITING ====================
+
+class TokenBucket:
+    """Async token bucket handing out `rate` tokens per second"""
+    
+    def __init__(self, rate: float, capacity: float = None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = asyncio.Lock()
+    
+    async def acquire(self):
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self._paused_until:
+                    await asyncio.sleep(self._paused_until - now)
+                    continue
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+    
+    def pause(self, seconds: float):
+        """Hand out no tokens for `seconds`, e.g. after a RetryAfter"""
+        self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+        self._tokens = 0
+        # Refill restarts when the pause ends rather than accruing during it
+        self._updated = self._paused_until
+
 # ==================== DATABASE MANAGER ====================
 
 class DatabaseManager:
-    def __init__(self, db_name: str):
+    def __init__(self, db_name: str, pool_size: int = DB_POOL_SIZE):
         self.db_name = db_name
+        # Long-lived connections keep SQLite's page cache warm between calls
+        self._pool = queue.Queue(maxsize=pool_size)
+        for _ in range(pool_size):
+            self._pool.put(self._connect())
+        self._settings_cache = TTLCache(maxsize=64, ttl=SETTINGS_CACHE_TTL)
+        self._user_cache = TTLCache(maxsize=10000, ttl=USER_CACHE_TTL)
+        # Keyed by (category, active_only); dropped on any product write
+        self._products_cache = TTLCache(maxsize=64, ttl=PRODUCTS_CACHE_TTL)
+        # SQLite allows a single writer; queue writers here instead of on SQLITE_BUSY
+        self._write_lock = threading.Lock()
+        # Per-message activity is buffered and written in batches by flush_activity
+        self._pending_activity = defaultdict(int)
+        self._last_seen = {}
+        # Game and reward points are buffered the same way by flush_points
+        self._pending_points = defaultdict(int)
+        self._pending_lock = threading.Lock()
         self.init_database()
+        # Admin and ban lists are small and rarely change, so keep them in memory
+        with self.get_connection() as conn:
+            self._admin_ids = {row[0] for row in conn.execute('SELECT admin_id FROM admins')}
+            self._banned_ids = {
+                row[0] for row in conn.execute('SELECT user_id FROM users WHERE is_banned = 1')
+            }
+            for key, value in conn.execute('SELECT key, value FROM settings'):
+                self._settings_cache.set(key, value)
+    
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(
+            self.db_name,
+            check_same_thread=False,
+            cached_statements=DB_STATEMENT_CACHE_SIZE
+        )
+        conn.row_factory = sqlite3.Row
+        for pragma in SQLITE_PRAGMAS:
+            conn.execute(pragma)
+        return conn
     
     @contextmanager
-    def get_connection(self):
-        conn = sqlite3.connect(self.db_name)
-        conn.row_factory = sqlite3.Row
+    def get_connection(self, write: bool = False):
+        if write:
+            self._write_lock.acquire()
+        conn = self._pool.get()
         try:
             yield conn
             conn.commit()
@@ -76,12 +246,17 @@ class DatabaseManager:
             conn.rollback()
             raise e
         finally:
-            conn.close()
+            self._pool.put(conn)
+            if write:
+                self._write_lock.release()
     
     def init_database(self):
-        with self.get_connection() as conn:
+        with self.get_connection(write=True) as conn:
             cursor = conn.cursor()
             
+            # WAL lets readers proceed while a writer commits
+            cursor.execute('PRAGMA journal_mode=WAL')
+            
             # Users table
             cursor.execute('''
                 CREATE TABLE IF NOT EXISTS users (
@@ -90,8 +265,8 @@ class DatabaseManager:
                     first_name TEXT,
                     last_name TEXT,
                     language_code TEXT,
-                    join_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    last_activity TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                    join_date INTEGER DEFAULT (strftime('%s', 'now')),
+                    last_activity INTEGER DEFAULT (strftime('%s', 'now')),
                     is_banned BOOLEAN DEFAULT 0,
                     is_premium BOOLEAN DEFAULT 0,
                     balance REAL DEFAULT 0.0,
@@ -103,6 +278,17 @@ class DatabaseManager:
                 )
             ''')
             
+            # Older databases stored user timestamps as ISO text;
+            # convert them to Unix seconds once
+            cursor.execute('''
+                UPDATE users SET join_date = CAST(strftime('%s', join_date) AS INTEGER)
+                WHERE typeof(join_date) = 'text'
+            ''')
+            cursor.execute('''
+                UPDATE users SET last_activity = CAST(strftime('%s', last_activity) AS INTEGER)
+                WHERE typeof(last_activity) = 'text'
+            ''')
+            
             # Admins table
             cursor.execute('''
                 CREATE TABLE IF NOT EXISTS admins (
@@ -179,6 +365,16 @@ class DatabaseManager:
                 )
             ''')
             
+            # Indexes for the per-user and per-category lookups
+            cursor.execute('CREATE INDEX IF NOT EXISTS idx_orders_user_created ON orders(user_id, created_at DESC)')
+            cursor.execute('CREATE INDEX IF NOT EXISTS idx_orders_user_status ON orders(user_id, status)')
+            cursor.execute('CREATE INDEX IF NOT EXISTS idx_tx_user_created ON transactions(user_id, created_at DESC)')
+            cursor.execute('CREATE INDEX IF NOT EXISTS idx_tickets_user_created ON tickets(user_id, created_at DESC)')
+            cursor.execute('CREATE INDEX IF NOT EXISTS idx_products_cat_active ON products(category, is_active)')
+            cursor.execute('CREATE INDEX IF NOT EXISTS idx_users_points_desc ON users(points DESC)')
+            cursor.execute('CREATE INDEX IF NOT EXISTS idx_users_referred_by ON users(referred_by)')
+            cursor.execute('CREATE INDEX IF NOT EXISTS idx_users_join_date ON users(join_date)')
+            
             # Initialize default settings
             default_settings = [
                 ('bot_name', '🤖 البوت الذكي'),
@@ -203,51 +399,117 @@ class DatabaseManager:
     
     def add_user(self, user_id: int, username: str, first_name: str, 
                  last_name: str, language_code: str, phone: str = None) -> bool:
-        with self.get_connection() as conn:
+        with self.get_connection(write=True) as conn:
             cursor = conn.cursor()
             referral_code = self.generate_referral_code(user_id)
-            try:
-                cursor.execute('''
-                    INSERT INTO users (user_id, username, first_name, last_name, 
-                                     language_code, referral_code, phone_number)
-                    VALUES (?, ?, ?, ?, ?, ?, ?)
-                ''', (user_id, username, first_name, last_name, language_code, referral_code, phone))
-                return True
-            except sqlite3.IntegrityError:
-                cursor.execute('''
-                    UPDATE users SET last_activity = CURRENT_TIMESTAMP,
-                    username = ?, first_name = ?, last_name = ?
-                    WHERE user_id = ?
-                ''', (username, first_name, last_name, user_id))
-                return False
+            now = int(time.time())
+            # Returning users keep their stored referral code, which tells
+            # the two upsert branches apart without a second statement
+            cursor.execute('''
+                INSERT INTO users (user_id, username, first_name, last_name, 
+                                 language_code, referral_code, phone_number,
+                                 join_date, last_activity)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+                ON CONFLICT(user_id) DO UPDATE SET
+                    last_activity = excluded.last_activity,
+                    username = excluded.username,
+                    first_name = excluded.first_name,
+                    last_name = excluded.last_name
+                RETURNING referral_code
+            ''', (user_id, username, first_name, last_name, language_code, referral_code, phone,
+                  now, now))
+            is_new = cursor.fetchone()[0] == referral_code
+        self._user_cache.pop(user_id)
+        return is_new
     
     def generate_referral_code(self, user_id: int) -> str:
-        code = f"REF{user_id}{''.join(random.choices(string.ascii_uppercase + string.digits, k=6))}"
+        code = f"REF{user_id}{secrets.token_hex(3).upper()}"
         return code
     
-    def get_user(self, user_id: int) -> Optional[Dict]:
+    def get_user(self, user_id: int) -> Optional[sqlite3.Row]:
+        cached = self._user_cache.get(user_id)
+        if cached is not None:
+            return cached
+        token = self._user_cache.reserve(user_id)
         with self.get_connection() as conn:
             cursor = conn.cursor()
             cursor.execute('SELECT * FROM users WHERE user_id = ?', (user_id,))
-            row = cursor.fetchone()
-            return dict(row) if row else None
+            user = cursor.fetchone()
+        self._user_cache.fill(user_id, token, user)
+        return user
     
     def update_user_activity(self, user_id: int):
-        with self.get_connection() as conn:
+        with self.get_connection(write=True) as conn:
             cursor = conn.cursor()
             cursor.execute('''
-                UPDATE users SET last_activity = CURRENT_TIMESTAMP,
+                UPDATE users SET last_activity = ?,
                 message_count = message_count + 1
                 WHERE user_id = ?
-            ''', (user_id,))
-    
-    def get_all_users(self, limit: int = 100, offset: int = 0) -> List[Dict]:
+            ''', (int(time.time()), user_id))
+        self._user_cache.pop(user_id)
+    
+    def record_activity(self, user_id: int):
+        """Buffer one message for the next flush_activity() call"""
+        with self._pending_lock:
+            self._pending_activity[user_id] += 1
+            self._last_seen[user_id] = int(time.time())
+    
+    def flush_activity(self) -> int:
+        """Write buffered activity in a single transaction, returns users updated"""
+        with self._pending_lock:
+            if not self._pending_activity:
+                return 0
+            batch = [
+                (count, self._last_seen[user_id], user_id)
+                for user_id, count in self._pending_activity.items()
+            ]
+            self._pending_activity.clear()
+            self._last_seen.clear()
+        
+        try:
+            with self.get_connection(write=True) as conn:
+                cursor = conn.cursor()
+                cursor.executemany('''
+                    UPDATE users SET message_count = message_count + ?,
+                    last_activity = ?
+                    WHERE user_id = ?
+                ''', batch)
+        except Exception:
+            # Re-queue the batch, merging with activity buffered in the meantime
+            with self._pending_lock:
+                for count, last_seen, user_id in batch:
+                    self._pending_activity[user_id] += count
+                    self._last_seen[user_id] = max(self._last_seen.get(user_id, 0), last_seen)
+            raise
+        return len(batch)
+    
+    def get_all_users(self, limit: int = 100, offset: int = 0) -> List[sqlite3.Row]:
         with self.get_connection() as conn:
             cursor = conn.cursor()
             cursor.execute('''
                 SELECT * FROM users ORDER BY join_date DESC LIMIT ? OFFSET ?
             ''', (limit, offset))
-            return [dict(row) for row in cursor.fetchall()]
+            return cursor.fetchall()
+    
+    def iter_user_id_batches(self, batch_size: int = 500) -> Iterator[List[int]]:
+        """Yield all user ids in batches, one short query per batch"""
+        last_id = None
+        while True:
+            with self.get_connection() as conn:
+                cursor = conn.cursor()
+                if last_id is None:
+                    cursor.execute('SELECT user_id FROM users ORDER BY user_id LIMIT ?',
+                                 (batch_size,))
+                else:
+                    cursor.execute('''
+                        SELECT user_id FROM users WHERE user_id > ?
+                        ORDER BY user_id LIMIT ?
+                    ''', (last_id, batch_size))
+                batch = [row[0] for row in cursor.fetchall()]
+            if not batch:
+                return
+            yield batch
+            last_id = batch[-1]
     
     def get_users_count(self) -> int:
         with self.get_connection() as conn:
@@ -256,102 +518,140 @@ class DatabaseManager:
             return cursor.fetchone()[0]
     
     def ban_user(self, user_id: int, ban: bool = True):
-        with self.get_connection() as conn:
+        with self.get_connection(write=True) as conn:
             cursor = conn.cursor()
             cursor.execute('UPDATE users SET is_banned = ? WHERE user_id = ?', 
                          (1 if ban else 0, user_id))
+            updated = cursor.rowcount > 0
+        self._user_cache.pop(user_id)
+        if ban and updated:
+            self._banned_ids.add(user_id)
+        elif not ban:
+            self._banned_ids.discard(user_id)
+    
+    def is_banned(self, user_id: int) -> bool:
+        return user_id in self._banned_ids
     
     def is_admin(self, user_id: int) -> bool:
-        with self.get_connection() as conn:
-            cursor = conn.cursor()
-            cursor.execute('SELECT 1 FROM admins WHERE admin_id = ?', (user_id,))
-            return cursor.fetchone() is not None
+        return user_id in self._admin_ids
     
     def add_admin(self, admin_id: int, added_by: int, level: int = 1):
-        with self.get_connection() as conn:
+        with self.get_connection(write=True) as conn:
             cursor = conn.cursor()
             cursor.execute('''
                 INSERT OR REPLACE INTO admins (admin_id, added_by, level)
                 VALUES (?, ?, ?)
             ''', (admin_id, added_by, level))
+        self._admin_ids.add(admin_id)
     
     def remove_admin(self, admin_id: int):
-        with self.get_connection() as conn:
+        with self.get_connection(write=True) as conn:
             cursor = conn.cursor()
             cursor.execute('DELETE FROM admins WHERE admin_id = ?', (admin_id,))
+        self._admin_ids.discard(admin_id)
     
-    def get_admins(self) -> List[Dict]:
+    def get_admins(self) -> List[sqlite3.Row]:
         with self.get_connection() as conn:
             cursor = conn.cursor()
             cursor.execute('SELECT * FROM admins ORDER BY added_date DESC')
-            return [dict(row) for row in cursor.fetchall()]
+            return cursor.fetchall()
     
     def get_setting(self, key: str) -> str:
+        cached = self._settings_cache.get(key)
+        if cached is not None:
+            return cached
         with self.get_connection() as conn:
             cursor = conn.cursor()
             cursor.execute('SELECT value FROM settings WHERE key = ?', (key,))
             row = cursor.fetchone()
-            return row[0] if row else ''
+            value = row[0] if row else ''
+        self._settings_cache.set(key, value)
+        return value
     
     def set_setting(self, key: str, value: str):
-        with self.get_connection() as conn:
+        with self.get_connection(write=True) as conn:
             cursor = conn.cursor()
             cursor.execute('''
                 INSERT OR REPLACE INTO settings (key, value, updated_at)
                 VALUES (?, ?, CURRENT_TIMESTAMP)
             ''', (key, value))
+        # Write through so the next read is served from memory
+        self._settings_cache.set(key, value)
     
     def add_product(self, name: str, description: str, price: float, 
                     stock: int, category: str, image_url: str = None) -> int:
-        with self.get_connection() as conn:
+        with self.get_connection(write=True) as conn:
             cursor = conn.cursor()
             cursor.execute('''
                 INSERT INTO products (name, description, price, stock, category, image_url)
                 VALUES (?, ?, ?, ?, ?, ?)
             ''', (name, description, price, stock, category, image_url))
-            return cursor.lastrowid
-    
-    def get_products(self, category: str = None, active_only: bool = True) -> List[Dict]:
+            product_id = cursor.lastrowid
+        self._invalidate_products(category)
+        return product_id
+    
+    def _invalidate_products(self, category: Optional[str]):
+        for active_only in (False, True):
+            self._products_cache.pop((category, active_only))
+            self._products_cache.pop((None, active_only))
+    
+    # Query text per (active_only, has_category), built once rather than per call
+    _PRODUCT_QUERIES = {
+        (active_only, has_category): (
+            'SELECT * FROM products WHERE 1=1'
+            + (' AND is_active = 1' if active_only else '')
+            + (' AND category = ?' if has_category else '')
+            + ' ORDER BY created_at DESC'
+        )
+        for active_only in (False, True)
+        for has_category in (False, True)
+    }
+    
+    def get_products(self, category: str = None, active_only: bool = True) -> List[sqlite3.Row]:
+        key = (category or None, bool(active_only))
+        products = self._products_cache.get(key)
+        if products is not None:
+            return products
+        token = self._products_cache.reserve(key)
         with self.get_connection() as conn:
             cursor = conn.cursor()
-            query = 'SELECT * FROM products WHERE 1=1'
-            params = []
-            if active_only:
-                query += ' AND is_active = 1'
-            if category:
-                query += ' AND category = ?'
-                params.append(category)
-            query += ' ORDER BY created_at DESC'
-            cursor.execute(query, params)
-            return [dict(row) for row in cursor.fetchall()]
-    
-    def get_product(self, product_id: int) -> Optional[Dict]:
+            query = self._PRODUCT_QUERIES[(bool(active_only), bool(category))]
+            cursor.execute(query, (category,) if category else ())
+            products = cursor.fetchall()
+        self._products_cache.fill(key, token, products)
+        return products
+    
+    def get_product(self, product_id: int) -> Optional[sqlite3.Row]:
         with self.get_connection() as conn:
             cursor = conn.cursor()
             cursor.execute('SELECT * FROM products WHERE product_id = ?', (product_id,))
-            row = cursor.fetchone()
-            return dict(row) if row else None
+            return cursor.fetchone()
     
     def create_order(self, user_id: int, product_id: int, quantity: int) -> int:
-        with self.get_connection() as conn:
+        with self.get_connection(write=True) as conn:
             cursor = conn.cursor()
-            product = self.get_product(product_id)
-            if not product or product['stock'] < quantity:
+            # Reserve stock first; the WHERE clause makes the check and
+            # decrement a single atomic step so orders cannot oversell
+            cursor.execute('''
+                UPDATE products SET stock = stock - ?
+                WHERE product_id = ? AND stock >= ?
+                RETURNING price, category
+            ''', (quantity, product_id, quantity))
+            row = cursor.fetchone()
+            if not row:
                 return -1
             
-            total_price = product['price'] * quantity
             cursor.execute('''
                 INSERT INTO orders (user_id, product_id, quantity, total_price)
                 VALUES (?, ?, ?, ?)
-            ''', (user_id, product_id, quantity, total_price))
-            
-            cursor.execute('''
-                UPDATE products SET stock = stock - ? WHERE product_id = ?
-            ''', (quantity, product_id))
-            
-            return cursor.lastrowid
-    
-    def get_user_orders(self, user_id: int) -> List[Dict]:
+                RETURNING order_id
+            ''', (user_id, product_id, quantity, row[0] * quantity))
+            order_id = cursor.fetchone()[0]
+        # Listings show stock, so drop the cached category after a sale
+        self._invalidate_products(row[1])
+        return order_id
+    
+    def get_user_orders(self, user_id: int) -> List[sqlite3.Row]:
         with self.get_connection() as conn:
             cursor = conn.cursor()
             cursor.execute('''
@@ -361,10 +661,10 @@ class DatabaseManager:
                 WHERE o.user_id = ? 
                 ORDER BY o.created_at DESC
             ''', (user_id,))
-            return [dict(row) for row in cursor.fetchall()]
+            return cursor.fetchall()
     
     def update_balance(self, user_id: int, amount: float) -> bool:
-        with self.get_connection() as conn:
+        with self.get_connection(write=True) as conn:
             cursor = conn.cursor()
             cursor.execute('SELECT balance FROM users WHERE user_id = ?', (user_id,))
             current = cursor.fetchone()
@@ -383,16 +683,47 @@ class DatabaseManager:
                 INSERT INTO transactions (user_id, type, amount, description)
                 VALUES (?, ?, ?, ?)
             ''', (user_id, 'credit' if amount > 0 else 'debit', abs(amount), 'Balance update'))
-            return True
+        self._user_cache.pop(user_id)
+        return True
     
     def add_points(self, user_id: int, points: int):
-        with self.get_connection() as conn:
+        with self.get_connection(write=True) as conn:
             cursor = conn.cursor()
             cursor.execute('UPDATE users SET points = points + ? WHERE user_id = ?',
                          (points, user_id))
+        self._user_cache.pop(user_id)
+    
+    def queue_points(self, user_id: int, points: int):
+        """Buffer a points award for the next flush_points() call"""
+        with self._pending_lock:
+            self._pending_points[user_id] += points
+    
+    def flush_points(self) -> int:
+        """Write buffered points awards in chunked transactions, returns users updated"""
+        with self._pending_lock:
+            if not self._pending_points:
+                return 0
+            batch = [(points, user_id) for user_id, points in self._pending_points.items()]
+            self._pending_points.clear()
+        
+        # Short transactions keep the write lock free for other writers
+        for start in range(0, len(batch), POINTS_FLUSH_BATCH):
+            chunk = batch[start:start + POINTS_FLUSH_BATCH]
+            try:
+                with self.get_connection(write=True) as conn:
+                    conn.executemany('UPDATE users SET points = points + ? WHERE user_id = ?', chunk)
+            except Exception:
+                # Re-queue this chunk and the unwritten rest for the next flush
+                with self._pending_lock:
+                    for points, user_id in batch[start:]:
+                        self._pending_points[user_id] += points
+                raise
+            for _, user_id in chunk:
+                self._user_cache.pop(user_id)
+        return len(batch)
     
     def create_ticket(self, user_id: int, subject: str, message: str) -> int:
-        with self.get_connection() as conn:
+        with self.get_connection(write=True) as conn:
             cursor = conn.cursor()
             cursor.execute('''
                 INSERT INTO tickets (user_id, subject, message)
@@ -400,15 +731,15 @@ class DatabaseManager:
             ''', (user_id, subject, message))
             return cursor.lastrowid
     
-    def get_user_tickets(self, user_id: int) -> List[Dict]:
+    def get_user_tickets(self, user_id: int) -> List[sqlite3.Row]:
         with self.get_connection() as conn:
             cursor = conn.cursor()
             cursor.execute('''
                 SELECT * FROM tickets WHERE user_id = ? ORDER BY created_at DESC
             ''', (user_id,))
-            return [dict(row) for row in cursor.fetchall()]
+            return cursor.fetchall()
     
-    def get_transactions(self, user_id: int, limit: int = 10) -> List[Dict]:
+    def get_transactions(self, user_id: int, limit: int = 10) -> List[sqlite3.Row]:
         with self.get_connection() as conn:
             cursor = conn.cursor()
             cursor.execute('''
@@ -417,140 +748,228 @@ class DatabaseManager:
                 ORDER BY created_at DESC 
                 LIMIT ?
             ''', (user_id, limit))
-            return [dict(row) for row in cursor.fetchall()]
+            return cursor.fetchall()
+    
+    def get_referral_stats(self, user_id: int) -> sqlite3.Row:
+        """Referral bonus, referral count and points earned from referrals"""
+        bonus = self.get_setting('referral_bonus')
+        with self.get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute('''
+                SELECT ? AS bonus, COUNT(*) AS referral_count,
+                       COUNT(*) * CAST(? AS INTEGER) AS earned
+                FROM users WHERE referred_by = ?
+            ''', (bonus, bonus, user_id))
+            return cursor.fetchone()
+    
+    def get_top_users(self, limit: int = 10) -> List[sqlite3.Row]:
+        with self.get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute('''
+                SELECT first_name, points FROM users 
+                ORDER BY points DESC LIMIT ?
+            ''', (limit,))
+            return cursor.fetchall()
+    
+    def get_stats(self) -> Dict:
+        with self.get_connection() as conn:
+            cursor = conn.cursor()
+            # Today's users are those who joined since midnight UTC
+            cursor.execute('''
+                SELECT
+                    (SELECT COUNT(*) FROM users) AS total_users,
+                    (SELECT COUNT(*) FROM users WHERE join_date >= ?) AS today_users,
+                    (SELECT COUNT(*) FROM orders) AS total_orders,
+                    (SELECT COUNT(*) FROM tickets WHERE status = 'open') AS open_tickets
+            ''', (int(time.time()) // 86400 * 86400,))
+            return dict(cursor.fetchone())
+    
+    def get_wallet_snapshot(self, user_id: int, limit: int = 5) -> Optional[Dict]:
+        """Balance, points, total spent and recent transactions in one round trip"""
+        with self.get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute('''
+                SELECT balance, points,
+                       (SELECT COALESCE(SUM(total_price), 0) FROM orders
+                        WHERE user_id = ? AND status = 'completed') AS total_spent
+                FROM users WHERE user_id = ?
+            ''', (user_id, user_id))
+            row = cursor.fetchone()
+            if not row:
+                return None
+            
+            snapshot = dict(row)
+            cursor.execute('''
+                SELECT * FROM transactions 
+                WHERE user_id = ? 
+                ORDER BY created_at DESC 
+                LIMIT ?
+            ''', (user_id, limit))
+            snapshot['transactions'] = cursor.fetchall()
+            return snapshot
 
 # Initialize database
 db = DatabaseManager(DATABASE_NAME)
 
+# One worker thread per pooled connection, so a call never waits for a connection
+db_executor = ThreadPoolExecutor(max_workers=DB_POOL_SIZE, thread_name_prefix='db')
+
+async def run_db(func, *args, **kwargs):
+    """Run a blocking database call on the DB executor, off the event loop"""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(db_executor, functools.partial(func, *args, **kwargs))
+
 # ==================== KEYBOARD LAYOUTS ====================
 
-def get_main_menu_keyboard(user_id: int) -> ReplyKeyboardMarkup:
-    """Main menu keyboard with control buttons"""
-    if db.is_admin(user_id):
-        keyboard = [
-            ["👤 حسابي", "🛒 المتجر", "💰 المحفظة"],
-            ["🎮 الألعاب والترفيه", "📢 الأخبار", "🔗 الإحالات"],
-            ["⚙️ الإعدادات", "📞 الدعم الفني", "❓ المساعدة"],
-            ["🔐 لوحة تحكم الأدمن"]
-        ]
-    else:
-        keyboard = [
-            ["👤 حسابي", "🛒 المتجر", "💰 المحفظة"],
-            ["🎮 الألعاب والترفيه", "📢 الأخبار", "🔗 الإحالات"],
-            ["⚙️ الإعدادات", "📞 الدعم الفني", "❓ المساعدة"]
-        ]
-    
-    return ReplyKeyboardMarkup(
-        keyboard, 
-        resize_keyboard=True,
-        one_time_keyboard=False,
-        input_field_placeholder="اختر من القائمة..."
-    )
+# Keyboards never change at runtime, so they are built once at import
 
-def get_admin_keyboard() -> ReplyKeyboardMarkup:
-    """Admin panel keyboard"""
-    keyboard = [
+_MAIN_MENU_ROWS = [
+    ["👤 حسابي", "🛒 المتجر", "💰 المحفظة"],
+    ["🎮 الألعاب والترفيه", "📢 الأخبار", "🔗 الإحالات"],
+    ["⚙️ الإعدادات", "📞 الدعم الفني", "❓ المساعدة"]
+]
+
+_MAIN_MENU_USER_KB = ReplyKeyboardMarkup(
+    _MAIN_MENU_ROWS,
+    resize_keyboard=True,
+    one_time_keyboard=False,
+    input_field_placeholder="اختر من القائمة..."
+)
+
+_MAIN_MENU_ADMIN_KB = ReplyKeyboardMarkup(
+    _MAIN_MENU_ROWS + [["🔐 لوحة تحكم الأدمن"]],
+    resize_keyboard=True,
+    one_time_keyboard=False,
+    input_field_placeholder="اختر من القائمة..."
+)
+
+_ADMIN_KB = ReplyKeyboardMarkup(
+    [
         ["📊 الإحصائيات", "👥 إدارة المستخدمين"],
         ["📢 إذاعة", "⚙️ إعدادات البوت"],
         ["🛍️ إدارة المنتجات", "🎫 التذاكر"],
         ["➕ إضافة أدمن", "➖ إزالة أدمن"],
         ["🔙 العودة للقائمة الرئيسية"]
-    ]
-    return ReplyKeyboardMarkup(
-        keyboard,
-        resize_keyboard=True,
-        one_time_keyboard=False
-    )
+    ],
+    resize_keyboard=True,
+    one_time_keyboard=False
+)
 
-def get_shop_keyboard() -> ReplyKeyboardMarkup:
-    """Shop categories keyboard"""
-    keyboard = [
+_SHOP_KB = ReplyKeyboardMarkup(
+    [
         ["🎮 منتجات رقمية", "👕 ملابس وأزياء"],
         ["📚 كتب ومراجع", "🎁 هدايا واكسسوارات"],
         ["🔍 البحث في المتجر", "🛒 عربة التسوق"],
         ["🔙 العودة للقائمة الرئيسية"]
-    ]
-    return ReplyKeyboardMarkup(
-        keyboard,
-        resize_keyboard=True
-    )
+    ],
+    resize_keyboard=True
+)
 
-def get_games_keyboard() -> ReplyKeyboardMarkup:
-    """Games menu keyboard"""
-    keyboard = [
+_GAMES_KB = ReplyKeyboardMarkup(
+    [
         ["🎲 لعبة النرد", "🎯 لعبة السهم"],
         ["🎰 آلة الحظ", "❓ تحدي المعرفة"],
         ["🏆 المتصدرين", "🎁 مكافآت يومية"],
         ["🔙 العودة للقائمة الرئيسية"]
-    ]
-    return ReplyKeyboardMarkup(
-        keyboard,
-        resize_keyboard=True
-    )
+    ],
+    resize_keyboard=True
+)
 
-def get_wallet_keyboard() -> ReplyKeyboardMarkup:
-    """Wallet keyboard"""
-    keyboard = [
+_WALLET_KB = ReplyKeyboardMarkup(
+    [
         ["💳 شحن الرصيد", "💸 سحب الأموال"],
         ["📜 سجل العمليات", "🎁 تحويل نقاط"],
         ["🔙 العودة للقائمة الرئيسية"]
-    ]
-    return ReplyKeyboardMarkup(
-        keyboard,
-        resize_keyboard=True
-    )
+    ],
+    resize_keyboard=True
+)
 
-def get_settings_keyboard() -> ReplyKeyboardMarkup:
-    """Settings keyboard"""
-    keyboard = [
+_SETTINGS_KB = ReplyKeyboardMarkup(
+    [
         ["🌐 تغيير اللغة", "🔔 إعدادات الإشعارات"],
         ["👤 تعديل الملف الشخصي", "🔒 الخصوصية والأمان"],
         ["📱 ربط رقم الهاتف", "🌙 الوضع الليلي"],
         ["❌ حذف الحساب", "🔙 العودة للقائمة الرئيسية"]
-    ]
-    return ReplyKeyboardMarkup(
-        keyboard,
-        resize_keyboard=True
-    )
+    ],
+    resize_keyboard=True
+)
 
-def get_support_keyboard() -> ReplyKeyboardMarkup:
-    """Support keyboard"""
-    keyboard = [
+_SUPPORT_KB = ReplyKeyboardMarkup(
+    [
         ["📝 إنشاء تذكرة جديدة"],
         ["📋 عرض تذاكري السابقة"],
         ["📞 التواصل المباشر", "❓ الأسئلة الشائعة"],
         ["🔙 العودة للقائمة الرئيسية"]
-    ]
-    return ReplyKeyboardMarkup(
-        keyboard,
-        resize_keyboard=True
-    )
+    ],
+    resize_keyboard=True
+)
+
+_CANCEL_KB = ReplyKeyboardMarkup(
+    [["❌ إلغاء"]],
+    resize_keyboard=True,
+    one_time_keyboard=True
+)
+
+_YES_NO_KB = ReplyKeyboardMarkup(
+    [["✅ نعم", "❌ لا"]],
+    resize_keyboard=True,
+    one_time_keyboard=True
+)
+
+_PROFILE_INLINE_KB = InlineKeyboardMarkup([
+    [InlineKeyboardButton("🔄 تحديث", callback_data='refresh_profile')],
+    [InlineKeyboardButton("📤 مشاركة البطاقة", callback_data='share_card')]
+])
+
+_REMOVE_KB = ReplyKeyboardRemove()
+
+def get_main_menu_keyboard(user_id: int) -> ReplyKeyboardMarkup:
+    """Main menu keyboard with control buttons"""
+    return _MAIN_MENU_ADMIN_KB if db.is_admin(user_id) else _MAIN_MENU_USER_KB
+
+def get_admin_keyboard() -> ReplyKeyboardMarkup:
+    """Admin panel keyboard"""
+    return _ADMIN_KB
+
+def get_shop_keyboard() -> ReplyKeyboardMarkup:
+    """Shop categories keyboard"""
+    return _SHOP_KB
+
+def get_games_keyboard() -> ReplyKeyboardMarkup:
+    """Games menu keyboard"""
+    return _GAMES_KB
+
+def get_wallet_keyboard() -> ReplyKeyboardMarkup:
+    """Wallet keyboard"""
+    return _WALLET_KB
+
+def get_settings_keyboard() -> ReplyKeyboardMarkup:
+    """Settings keyboard"""
+    return _SETTINGS_KB
+
+def get_support_keyboard() -> ReplyKeyboardMarkup:
+    """Support keyboard"""
+    return _SUPPORT_KB
 
 def get_cancel_keyboard() -> ReplyKeyboardMarkup:
     """Cancel/Back keyboard"""
-    keyboard = [["❌ إلغاء"]]
-    return ReplyKeyboardMarkup(
-        keyboard,
-        resize_keyboard=True,
-        one_time_keyboard=True
-    )
+    return _CANCEL_KB
 
 def get_yes_no_keyboard() -> ReplyKeyboardMarkup:
     """Yes/No confirmation"""
-    keyboard = [["✅ نعم", "❌ لا"]]
-    return ReplyKeyboardMarkup(
-        keyboard,
-        resize_keyboard=True,
-        one_time_keyboard=True
-    )
+    return _YES_NO_KB
+
+def get_profile_keyboard() -> InlineKeyboardMarkup:
+    """Profile card inline buttons"""
+    return _PROFILE_INLINE_KB
 
 def remove_keyboard() -> ReplyKeyboardRemove:
     """Remove keyboard"""
-    return ReplyKeyboardRemove()
+    return _REMOVE_KB
 
 # ==================== MESSAGE TEXTS ====================
 
-TEXTS = {
+TEXTS = MappingProxyType({
     'welcome': """
 🌟 *أهلاً وسهلاً بك في {bot_name}* 🌟
 
@@ -562,25 +981,6 @@ TEXTS = {
 • 📞 دعم فني 24/7
 
 🎯 *اختر من القائمة أدناه للبدء:*
-""",
-    
-    'profile': """
-👤 *الملف الشخصي*
-
-🆔 *المعرف:* `{user_id}`
-👤 *الاسم:* {first_name} {last_name}
-📧 *المستخدم:* @{username}
-📱 *الهاتف:* {phone}
-
-⭐ *النقاط:* {points} نقطة
-💰 *الرصيد:* {balance} ريال
-🏆 *الرتبة:* {rank}
-
-📅 *تاريخ الانضمام:* {join_date}
-📨 *عدد الرسائل:* {message_count}
-
-🔗 *كود الإحالة:*
-`{referral_code}`
 """,
     
     'admin_welcome': """
@@ -589,17 +989,6 @@ TEXTS = {
 ⚠️ *تنبيه:* هذه المنطقة للمشرفين فقط!
 
 اختر الإجراء المطلوب من القائمة:
-""",
-    
-    'wallet': """
-💰 *المحفظة الإلكترونية*
-
-💵 *الرصيد المتاح:* `{balance}` ريال
-⭐ *النقاط:* `{points}` نقطة
-📊 *إجمالي الإنفاق:* `{total_spent}` ريال
-
-💳 *آخر العمليات:*
-{transactions}
 """,
     
     'shop': """
@@ -623,7 +1012,100 @@ TEXTS = {
 • تجنب إرسال رسائل متكررة
 """,
     
-    'games': """
+    'help': """
+❓ *مركز المساعدة*
+
+📌 *الأوامر المتاحة:*
+/start - بدء البوت
+/help - عرض المساعدة
+/profile - حسابي
+/support - الدعم الفني
+
+💡 *نصائح:*
+• استخدم الأزرار للتنقل السريع
+• اجمع النقاط من الإحالات والألعاب
+• تابع الأخبار للعروض الخاصة
+    """,
+    
+    'main_menu': "🏠 *القائمة الرئيسية*",
+    
+    'settings': "⚙️ *الإعدادات*\n\nاختر الإعداد المراد تعديله:",
+    
+    'broadcast_prompt': "📢 أرسل رسالتك للإذاعة (نص، صورة، فيديو، ملف):\n\nللإلغاء اضغط ❌ إلغاء",
+    
+    'admin_users': (
+        "👥 إدارة المستخدمين\n\n"
+        "• للبحث: أرسل /user [ID]\n"
+        "• للحظر: /ban [ID]\n"
+        "• للفك: /unban [ID]"
+    ),
+    
+    'admin_products': (
+        "🛍️ إدارة المنتجات\n\n"
+        "• إضافة: /addproduct\n"
+        "• تعديل: /editproduct [ID]\n"
+        "• حذف: /delproduct [ID]"
+    ),
+    
+    'admin_tickets': (
+        "🎫 إدارة التذاكر\n\n"
+        "لعرض التذاكر المفتوحة: /tickets"
+    )
+})
+
+# Profile ranks, as (minimum points, label) in ascending order
+RANK_TIERS = (
+    (0, "🥉 برونزي"),
+    (100, "🥈 فضي"),
+    (500, "🥇 ذهبي"),
+    (1000, "💎 ماسي"),
+)
+RANK_THRESHOLDS = [points for points, _ in RANK_TIERS]
+RANK_NAMES = [name for _, name in RANK_TIERS]
+
+def format_timestamp(timestamp: int) -> str:
+    """Format a stored Unix timestamp (UTC) for display"""
+    return datetime.fromtimestamp(timestamp, timezone.utc).strftime('%Y-%m-%d %H:%M:%S')
+
+# Hot templates are f-strings so each render skips str.format parsing
+
+def render_profile(user: sqlite3.Row, rank: str) -> str:
+    """Profile card text"""
+    return f"""
+👤 *الملف الشخصي*
+
+🆔 *المعرف:* `{user['user_id']}`
+👤 *الاسم:* {user['first_name']} {user['last_name'] or ''}
+📧 *المستخدم:* @{user['username'] or 'غير متوفر'}
+📱 *الهاتف:* {user['phone_number'] or 'غير مربوط'}
+
+⭐ *النقاط:* {user['points']} نقطة
+💰 *الرصيد:* {user['balance']} ريال
+🏆 *الرتبة:* {rank}
+
+📅 *تاريخ الانضمام:* {format_timestamp(user['join_date'])}
+📨 *عدد الرسائل:* {user['message_count']}
+
+🔗 *كود الإحالة:*
+`{user['referral_code']}`
+"""
+
+def render_wallet(wallet: Dict, transactions: str) -> str:
+    """Wallet summary text"""
+    return f"""
+💰 *المحفظة الإلكترونية*
+
+💵 *الرصيد المتاح:* `{wallet['balance']}` ريال
+⭐ *النقاط:* `{wallet['points']}` نقطة
+📊 *إجمالي الإنفاق:* `{wallet['total_spent']}` ريال
+
+💳 *آخر العمليات:*
+{transactions}
+"""
+
+def render_games(daily_prize: str, games_played: str, game_points: str) -> str:
+    """Games menu text"""
+    return f"""
 🎮 *مركز الألعاب*
 
 🏆 *جوائز يومية:* {daily_prize}
@@ -632,7 +1114,32 @@ TEXTS = {
 
 🎯 اختر لعبة للبدء:
 """
-}
+
+def render_referral(bonus: str, link: str, referral_count: int, earned: int) -> str:
+    """Referral summary text"""
+    return f"""
+🔗 *نظام الإحالات*
+
+💡 شارك رابطك واكسب *{bonus}* نقطة لكل صديق!
+
+🔗 رابط الإحالة:
+`{link}`
+
+📊 إحصائياتك:
+• عدد الإحالات: {referral_count}
+• النقاط المكتسبة: {earned}
+"""
+
+def render_stats(stats: Dict) -> str:
+    """Admin statistics text"""
+    return f"""
+📊 *إحصائيات البوت*
+
+👥 المستخدمين: {stats['total_users']}
+📈 جدد اليوم: {stats['today_users']}
+🛒 الطلبات: {stats['total_orders']}
+🎫 التذاكر المفتوحة: {stats['open_tickets']}
+"""
 
 # ==================== BOT HANDLERS ====================
 
@@ -642,7 +1149,8 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     chat_id = update.effective_chat.id
     
     # Add/update user
-    is_new = db.add_user(
+    is_new = await run_db(
+        db.add_user,
         user_id=user.id,
         username=user.username or '',
         first_name=user.first_name or '',
@@ -651,18 +1159,17 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     )
     
     # Check ban
-    user_data = db.get_user(user.id)
-    if user_data and user_data['is_banned']:
+    if db.is_banned(user.id):
         await update.message.reply_text("⛔ تم حظرك من استخدام هذا البوت.")
         return
     
     # Send welcome
-    bot_name = db.get_setting('bot_name')
+    bot_name = await run_db(db.get_setting, 'bot_name')
     welcome_text = TEXTS['welcome'].format(bot_name=bot_name)
     
     if is_new:
         welcome_text += "\n🎁 *مكافأة ترحيبية:* 10 نقاط!"
-        db.add_points(user.id, 10)
+        await run_db(db.add_points, user.id, 10)
         await update.message.reply_text(
             "🎉 أهلاً بك لأول مرة! لقد حصلت على 10 نقاط ترحيبية!"
         )
@@ -679,107 +1186,22 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     text = update.message.text
     user_id = user.id
     
-    # Update activity
-    db.update_user_activity(user_id)
+    # Update activity (flushed in batches by flush_activity_job)
+    db.record_activity(user_id)
     
     # Check ban
-    user_data = db.get_user(user_id)
-    if user_data and user_data['is_banned']:
+    if db.is_banned(user_id):
         await update.message.reply_text("⛔ تم حظرك من استخدام هذا البوت.")
         return
     
-    # Route messages
-    if text == "👤 حسابي":
-        await show_profile(update, context)
-    elif text == "🛒 المتجر":
-        await show_shop(update, context)
-    elif text == "💰 المحفظة":
-        await show_wallet(update, context)
-    elif text == "🎮 الألعاب والترفيه":
-        await show_games(update, context)
-    elif text == "📢 الأخبار":
-        await show_news(update, context)
-    elif text == "🔗 الإحالات":
-        await show_referral(update, context)
-    elif text == "⚙️ الإعدادات":
-        await show_settings(update, context)
-    elif text == "📞 الدعم الفني":
-        await show_support(update, context)
-    elif text == "❓ المساعدة":
-        await show_help(update, context)
-    elif text == "🔐 لوحة تحكم الأدمن":
-        await show_admin_panel(update, context)
-    elif text == "🔙 العودة للقائمة الرئيسية":
-        await back_to_main(update, context)
-    
-    # Admin commands
-    elif text == "📊 الإحصائيات":
-        await admin_stats(update, context)
-    elif text == "👥 إدارة المستخدمين":
-        await admin_users(update, context)
-    elif text == "📢 إذاعة":
-        await admin_broadcast_start(update, context)
-    elif text == "⚙️ إعدادات البوت":
-        await admin_settings(update, context)
-    elif text == "🛍️ إدارة المنتجات":
-        await admin_products(update, context)
-    elif text == "🎫 التذاكر":
-        await admin_tickets(update, context)
-    elif text == "➕ إضافة أدمن":
-        await admin_add_start(update, context)
-    elif text == "➖ إزالة أدمن":
-        await admin_remove_start(update, context)
-    
-    # Shop categories
-    elif text == "🎮 منتجات رقمية":
-        await show_category(update, context, "digital")
-    elif text == "👕 ملابس وأزياء":
-        await show_category(update, context, "clothing")
-    elif text == "📚 كتب ومراجع":
-        await show_category(update, context, "books")
-    elif text == "🎁 هدايا واكسسوارات":
-        await show_category(update, context, "gifts")
-    
-    # Games
-    elif text == "🎲 لعبة النرد":
-        await play_dice(update, context)
-    elif text == "🎯 لعبة السهم":
-        await play_dart(update, context)
-    elif text == "🎰 آلة الحظ":
-        await play_slots(update, context)
-    elif text == "❓ تحدي المعرفة":
-        await play_trivia(update, context)
-    elif text == "🏆 المتصدرين":
-        await show_leaderboard(update, context)
-    elif text == "🎁 مكافآت يومية":
-        await claim_daily(update, context)
-    
-    # Wallet
-    elif text == "💳 شحن الرصيد":
-        await deposit_start(update, context)
-    elif text == "💸 سحب الأموال":
-        await withdraw_start(update, context)
-    elif text == "📜 سجل العمليات":
-        await show_transactions(update, context)
-    
-    # Settings
-    elif text == "🌐 تغيير اللغة":
-        await change_language(update, context)
-    elif text == "🔔 إعدادات الإشعارات":
-        await notification_settings(update, context)
-    elif text == "👤 تعديل الملف الشخصي":
-        await edit_profile(update, context)
-    
-    # Support
-    elif text == "📝 إنشاء تذكرة جديدة":
-        await create_ticket_start(update, context)
-    elif text == "📋 عرض تذاكري السابقة":
-        await show_my_tickets(update, context)
-    elif text == "❌ إلغاء":
-        await cancel_operation(update, context)
+    # Route menu buttons
+    handler = MENU_HANDLERS.get(text)
+    if handler:
+        await handler(update, context)
+        return
     
     # Handle input states
-    elif context.user_data.get('awaiting_input'):
+    if context.user_data.get('state'):
         await handle_user_input(update, context, text)
     else:
         await update.message.reply_text(
@@ -792,45 +1214,21 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def show_profile(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Show user profile"""
     user_id = update.effective_user.id
-    user = db.get_user(user_id)
+    user = await run_db(db.get_user, user_id)
     
     if not user:
         await update.message.reply_text("⚠️ خطأ في تحميل البيانات")
         return
     
     # Determine rank
-    if user['points'] >= 1000:
-        rank = "💎 ماسي"
-    elif user['points'] >= 500:
-        rank = "🥇 ذهبي"
-    elif user['points'] >= 100:
-        rank = "🥈 فضي"
-    else:
-        rank = "🥉 برونزي"
-    
-    text = TEXTS['profile'].format(
-        user_id=user['user_id'],
-        first_name=user['first_name'],
-        last_name=user['last_name'] or '',
-        username=user['username'] or 'غير متوفر',
-        phone=user['phone_number'] or 'غير مربوط',
-        points=user['points'],
-        balance=user['balance'],
-        rank=rank,
-        join_date=user['join_date'],
-        message_count=user['message_count'],
-        referral_code=user['referral_code']
-    )
+    rank = RANK_NAMES[max(bisect.bisect_right(RANK_THRESHOLDS, user['points']) - 1, 0)]
     
-    buttons = [
-        [InlineKeyboardButton("🔄 تحديث", callback_data='refresh_profile')],
-        [InlineKeyboardButton("📤 مشاركة البطاقة", callback_data='share_card')]
-    ]
+    text = render_profile(user, rank)
     
     await update.message.reply_text(
         text,
         parse_mode=ParseMode.MARKDOWN,
-        reply_markup=InlineKeyboardMarkup(buttons)
+        reply_markup=get_profile_keyboard()
     )
 
 async def show_shop(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -844,33 +1242,22 @@ async def show_shop(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def show_wallet(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Show wallet"""
     user_id = update.effective_user.id
-    user = db.get_user(user_id)
+    wallet = await run_db(db.get_wallet_snapshot, user_id, 5)
+    
+    if not wallet:
+        await update.message.reply_text("⚠️ خطأ في تحميل البيانات")
+        return
     
-    # Get transactions
-    transactions_list = db.get_transactions(user_id, 5)
-    trans_text = ""
+    transactions_list = wallet['transactions']
     if transactions_list:
-        for t in transactions_list:
-            emoji = "➕" if t['type'] == 'credit' else "➖"
-            trans_text += f"{emoji} {t['amount']} ريال - {t['description'][:20]}\n"
+        trans_text = "".join(
+            f"{'➕' if t['type'] == 'credit' else '➖'} {t['amount']} ريال - {t['description'][:20]}\n"
+            for t in transactions_list
+        )
     else:
         trans_text = "لا توجد عمليات حديثة"
     
-    # Calculate total spent
-    with db.get_connection() as conn:
-        cursor = conn.cursor()
-        cursor.execute('''
-            SELECT COALESCE(SUM(total_price), 0) FROM orders 
-            WHERE user_id = ? AND status = 'completed'
-        ''', (user_id,))
-        total_spent = cursor.fetchone()[0]
-    
-    text = TEXTS['wallet'].format(
-        balance=user['balance'],
-        points=user['points'],
-        total_spent=total_spent,
-        transactions=trans_text
-    )
+    text = render_wallet(wallet, trans_text)
     
     await update.message.reply_text(
         text,
@@ -883,7 +1270,7 @@ async def show_games(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
     
     # Get user's game stats
-    text = TEXTS['games'].format(
+    text = render_games(
         daily_prize="100 نقطة",
         games_played="0",
         game_points="0"
@@ -903,9 +1290,7 @@ async def show_news(update: Update, context: ContextTypes.DEFAULT_TYPE):
         "📱 تم إضافة دعم الدفع الإلكتروني"
     ]
     
-    text = "📰 *آخر الأخبار:*\n\n"
-    for item in news_items:
-        text += f"• {item}\n\n"
+    text = "📰 *آخر الأخبار:*\n\n" + "".join(f"• {item}\n\n" for item in news_items)
     
     await update.message.reply_text(
         text,
@@ -916,33 +1301,19 @@ async def show_news(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def show_referral(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Show referral system"""
     user_id = update.effective_user.id
-    user = db.get_user(user_id)
     
-    # Count referrals
-    with db.get_connection() as conn:
-        cursor = conn.cursor()
-        cursor.execute('SELECT COUNT(*) FROM users WHERE referred_by = ?', (user_id,))
-        referral_count = cursor.fetchone()[0]
-    
-    bonus = db.get_setting('referral_bonus')
-    bot_username = context.bot.username
+    # Independent lookups run concurrently on the DB executor
+    user, stats = await asyncio.gather(
+        run_db(db.get_user, user_id),
+        run_db(db.get_referral_stats, user_id)
+    )
+    link = f"t.me/{context.bot.username}?start={user['referral_code']}"
     
-    text = f"""
-🔗 *نظام الإحالات*
-
-💡 شارك رابطك واكسب *{bonus}* نقطة لكل صديق!
-
-🔗 رابط الإحالة:
-`t.me/{bot_username}?start={user['referral_code']}`
-
-📊 إحصائياتك:
-• عدد الإحالات: {referral_count}
-• النقاط المكتسبة: {referral_count * int(bonus)}
-"""
+    text = render_referral(stats['bonus'], link, stats['referral_count'], stats['earned'])
     
     buttons = [[InlineKeyboardButton(
         "📤 مشاركة الرابط",
-        url=f"https://t.me/share/url?url=t.me/{bot_username}?start={user['referral_code']}"
+        url=f"https://t.me/share/url?url={link}"
     )]]
     
     await update.message.reply_text(
@@ -954,7 +1325,7 @@ async def show_referral(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def show_settings(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Show settings"""
     await update.message.reply_text(
-        "⚙️ *الإعدادات*\n\nاختر الإعداد المراد تعديله:",
+        TEXTS['settings'],
         parse_mode=ParseMode.MARKDOWN,
         reply_markup=get_settings_keyboard()
     )
@@ -969,22 +1340,8 @@ async def show_support(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 async def show_help(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Show help"""
-    text = """
-❓ *مركز المساعدة*
-
-📌 *الأوامر المتاحة:*
-/start - بدء البوت
-/help - عرض المساعدة
-/profile - حسابي
-/support - الدعم الفني
-
-💡 *نصائح:*
-• استخدم الأزرار للتنقل السريع
-• اجمع النقاط من الإحالات والألعاب
-• تابع الأخبار للعروض الخاصة
-    """
     await update.message.reply_text(
-        text,
+        TEXTS['help'],
         parse_mode=ParseMode.MARKDOWN,
         reply_markup=get_main_menu_keyboard(update.effective_user.id)
     )
@@ -992,7 +1349,7 @@ async def show_help(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def back_to_main(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Return to main menu"""
     await update.message.reply_text(
-        "🏠 *القائمة الرئيسية*",
+        TEXTS['main_menu'],
         parse_mode=ParseMode.MARKDOWN,
         reply_markup=get_main_menu_keyboard(update.effective_user.id)
     )
@@ -1002,7 +1359,6 @@ async def back_to_main(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def play_dice(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Play dice game"""
     msg = await update.message.reply_text("🎲 جاري رمي النرد...")
-    await asyncio.sleep(1)
     
     dice_msg = await context.bot.send_dice(
         chat_id=update.effective_chat.id,
@@ -1012,12 +1368,9 @@ async def play_dice(update: Update, context: ContextTypes.DEFAULT_TYPE):
     value = dice_msg.dice.value
     points = value * 5
     
-    await msg.delete()
-    await update.message.reply_text(
-        f"🎲 النتيجة: {value}\n⭐ ربحت {points} نقطة!",
-        reply_markup=get_games_keyboard()
-    )
-    db.add_points(update.effective_user.id, points)
+    # Reuse the placeholder; the games reply keyboard is already on screen
+    await msg.edit_text(f"🎲 النتيجة: {value}\n⭐ ربحت {points} نقطة!")
+    db.queue_points(update.effective_user.id, points)
 
 async def play_dart(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Play dart game"""
@@ -1036,9 +1389,8 @@ async def play_dart(update: Update, context: ContextTypes.DEFAULT_TYPE):
         points = value * 10
         text = f"🎯 النتيجة: {value}\n⭐ ربحت {points} نقطة!"
     
-    await msg.delete()
-    await update.message.reply_text(text, reply_markup=get_games_keyboard())
-    db.add_points(update.effective_user.id, points)
+    await msg.edit_text(text)
+    db.queue_points(update.effective_user.id, points)
 
 async def play_slots(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Play slots"""
@@ -1060,52 +1412,82 @@ async def play_slots(update: Update, context: ContextTypes.DEFAULT_TYPE):
         points = 10
         text = f"🎰 حظ أوفر المرة القادمة! 10 نقاط"
     
-    await msg.delete()
-    await update.message.reply_text(text, reply_markup=get_games_keyboard())
-    db.add_points(update.effective_user.id, points)
+    await msg.edit_text(text)
+    db.queue_points(update.effective_user.id, points)
+
+# (question, options, index of correct option, points)
+QUESTIONS = (
+    ('ما هي عاصمة المملكة العربية السعودية؟', ('جدة', 'الرياض', 'مكة', 'الدمام'), 1, 50),
+    ('كم عدد أيام السنة الكبيسة؟', ('365', '366', '364', '367'), 1, 30),
+)
+
+# Question text and answer buttons are fixed, so render each card once.
+# Answer callback data is trivia:<selected><correct><points>, where the two
+# option indexes are single digits
+TRIVIA_CARDS = tuple(
+    (
+        f"❓ *سؤال:*\n\n{q_text}\n\n💰 الجائزة: {points} نقطة",
+        InlineKeyboardMarkup([
+            [InlineKeyboardButton(opt, callback_data=f'trivia:{i}{correct}{points}')]
+            for i, opt in enumerate(options)
+        ])
+    )
+    for q_text, options, correct, points in QUESTIONS
+)
 
 async def play_trivia(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Play trivia"""
-    questions = [
-        {
-            'q': 'ما هي عاصمة المملكة العربية السعودية؟',
-            'options': ['جدة', 'الرياض', 'مكة', 'الدمام'],
-            'correct': 1,
-            'points': 50
-        },
-        {
-            'q': 'كم عدد أيام السنة الكبيسة؟',
-            'options': ['365', '366', '364', '367'],
-            'correct': 1,
-            'points': 30
-        }
-    ]
-    
-    q = random.choice(questions)
-    
-    buttons = [[InlineKeyboardButton(opt, callback_data=f'trivia_{i}_{q["correct"]}_{q["points"]}')] 
-               for i, opt in enumerate(q['options'])]
+    text, keyboard = random.choice(TRIVIA_CARDS)
     
     await update.message.reply_text(
-        f"❓ *سؤال:*\n\n{q['q']}\n\n💰 الجائزة: {q['points']} نقطة",
+        text,
         parse_mode=ParseMode.MARKDOWN,
-        reply_markup=InlineKeyboardMarkup(buttons)
+        reply_markup=keyboard
+    )
+
+async def trivia_answer(update: Update, context: ContextTypes.DEFAULT_TYPE, payload: str):
+    """Score a trivia answer button"""
+    query = update.callback_query
+    
+    if payload[0] == payload[1]:
+        points = int(payload[2:])
+        db.queue_points(update.effective_user.id, points)
+        text = f"✅ إجابة صحيحة! ربحت {points} نقطة"
+    else:
+        text = "❌ إجابة خاطئة! حاول مرة أخرى"
+    
+    await query.edit_message_text(text)
+
+MEDALS = ('🥇', '🥈', '🥉')
+
+def render_leaderboard(top_users: List[sqlite3.Row]) -> str:
+    """Leaderboard text"""
+    rows = ["🏆 *أفضل اللاعبين:*", ""]
+    rows.extend(
+        f"{MEDALS[i] if i < len(MEDALS) else f'{i + 1}.'} {name} - {points} نقطة"
+        for i, (name, points) in enumerate(top_users)
     )
+    return "\n".join(rows) + "\n"
+
+_leaderboard_cache = TTLCache(maxsize=1, ttl=LEADERBOARD_CACHE_TTL)
+_leaderboard_lock = asyncio.Lock()
+
+async def get_leaderboard_text() -> str:
+    """Rendered top 10, rebuilt at most once per LEADERBOARD_CACHE_TTL"""
+    text = _leaderboard_cache.get('top10')
+    if text is not None:
+        return text
+    # Concurrent presses wait for a single refresh instead of each querying
+    async with _leaderboard_lock:
+        text = _leaderboard_cache.get('top10')
+        if text is None:
+            text = render_leaderboard(await run_db(db.get_top_users, 10))
+            _leaderboard_cache.set('top10', text)
+    return text
 
 async def show_leaderboard(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Show leaderboard"""
-    with db.get_connection() as conn:
-        cursor = conn.cursor()
-        cursor.execute('''
-            SELECT first_name, points FROM users 
-            ORDER BY points DESC LIMIT 10
-        ''')
-        top_users = cursor.fetchall()
-    
-    text = "🏆 *أفضل اللاعبين:*\n\n"
-    for i, (name, points) in enumerate(top_users, 1):
-        medal = {1: '🥇', 2: '🥈', 3: '🥉'}.get(i, f'{i}.')
-        text += f"{medal} {name} - {points} نقطة\n"
+    text = await get_leaderboard_text()
     
     await update.message.reply_text(text, parse_mode=ParseMode.MARKDOWN)
 
@@ -1113,7 +1495,7 @@ async def claim_daily(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Claim daily reward"""
     # In real implementation, check last claim date
     points = random.randint(10, 100)
-    db.add_points(update.effective_user.id, points)
+    db.queue_points(update.effective_user.id, points)
     await update.message.reply_text(
         f"🎁 مكافأتك اليومية: {points} نقطة!",
         reply_markup=get_games_keyboard()
@@ -1121,9 +1503,64 @@ async def claim_daily(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 # ==================== SHOP HANDLERS ====================
 
+PRODUCT_SEPARATOR = "\n\n───\n\n"
+
+def utf16_len(text: str) -> int:
+    """Length as Telegram counts it, in UTF-16 code units"""
+    return len(text.encode('utf-16-le')) // 2
+
+def truncate_utf16(text: str, limit: int) -> str:
+    """Cut text to at most `limit` UTF-16 code units without splitting a character"""
+    data = text.encode('utf-16-le')
+    if len(data) <= limit * 2:
+        return text
+    return data[:limit * 2].decode('utf-16-le', 'ignore')
+
+def render_product(product: sqlite3.Row) -> str:
+    """Render a single product block, trimming the description to fit one message"""
+    header = (
+        f"📦 *{product['name']}*\n"
+        f"💰 السعر: {product['price']} ريال\n"
+        f"📋 "
+    )
+    footer = f"\n📊 المتاح: {product['stock']} قطعة"
+    description = str(product['description'])
+    
+    room = MESSAGE_MAX_LENGTH - utf16_len(header) - utf16_len(footer)
+    if utf16_len(description) > room:
+        description = truncate_utf16(description, max(room - 1, 0)) + "…"
+    return header + description + footer
+
+def paginate_products(products: List[sqlite3.Row]) -> Iterator[tuple]:
+    """Group product blocks into (text, buttons) pages that fit one message"""
+    blocks: List[str] = []
+    buttons: List[list] = []
+    length = 0
+    separator_length = utf16_len(PRODUCT_SEPARATOR)
+    
+    for product in products:
+        block = render_product(product)
+        block_length = utf16_len(block)
+        extra = block_length + (separator_length if blocks else 0)
+        if blocks and length + extra > MESSAGE_MAX_LENGTH:
+            yield PRODUCT_SEPARATOR.join(blocks), buttons
+            blocks, buttons = [], []
+            extra = block_length
+            length = 0
+        
+        blocks.append(block)
+        buttons.append([InlineKeyboardButton(
+            f"🛒 {product['name']}",
+            callback_data=f"add_cart:{product['product_id']}"
+        )])
+        length += extra
+    
+    if blocks:
+        yield PRODUCT_SEPARATOR.join(blocks), buttons
+
 async def show_category(update: Update, context: ContextTypes.DEFAULT_TYPE, category: str):
     """Show products in category"""
-    products = db.get_products(category=category)
+    products = await run_db(db.get_products, category=category)
     
     if not products:
         await update.message.reply_text(
@@ -1132,17 +1569,7 @@ async def show_category(update: Update, context: ContextTypes.DEFAULT_TYPE, cate
         )
         return
     
-    for product in products:
-        text = f"📦 *{product['name']}*\n"
-        text += f"💰 السعر: {product['price']} ريال\n"
-        text += f"📋 {product['description']}\n"
-        text += f"📊 المتاح: {product['stock']} قطعة"
-        
-        buttons = [[InlineKeyboardButton(
-            "🛒 أضف للسلة", 
-            callback_data=f"add_cart_{product['product_id']}"
-        )]]
-        
+    for text, buttons in paginate_products(products):
         await update.message.reply_text(
             text,
             parse_mode=ParseMode.MARKDOWN,
@@ -1151,6 +1578,16 @@ async def show_category(update: Update, context: ContextTypes.DEFAULT_TYPE, cate
 
 # ==================== ADMIN HANDLERS ====================
 
+def admin_only(handler):
+    """Reject the update unless it comes from an admin"""
+    @functools.wraps(handler)
+    async def wrapper(update: Update, context: ContextTypes.DEFAULT_TYPE, *args):
+        if not db.is_admin(update.effective_user.id):
+            await update.message.reply_text("⛔ ليس لديك صلاحية!")
+            return
+        await handler(update, context, *args)
+    return wrapper
+
 async def show_admin_panel(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Show admin panel"""
     user_id = update.effective_user.id
@@ -1167,50 +1604,29 @@ async def show_admin_panel(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 async def admin_stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Show statistics"""
-    total_users = db.get_users_count()
+    stats = await run_db(db.get_stats)
     
-    with db.get_connection() as conn:
-        cursor = conn.cursor()
-        cursor.execute('SELECT COUNT(*) FROM users WHERE date(join_date) = date("now")')
-        today_users = cursor.fetchone()[0]
-        
-        cursor.execute('SELECT COUNT(*) FROM orders')
-        total_orders = cursor.fetchone()[0]
-        
-        cursor.execute("SELECT COUNT(*) FROM tickets WHERE status = 'open'")
-        open_tickets = cursor.fetchone()[0]
-    
-    text = f"""
-📊 *إحصائيات البوت*
-
-👥 المستخدمين: {total_users}
-📈 جدد اليوم: {today_users}
-🛒 الطلبات: {total_orders}
-🎫 التذاكر المفتوحة: {open_tickets}
-"""
-    await update.message.reply_text(text, parse_mode=ParseMode.MARKDOWN)
+    await update.message.reply_text(render_stats(stats), parse_mode=ParseMode.MARKDOWN)
 
+@admin_only
 async def admin_broadcast_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Start broadcast"""
     await update.message.reply_text(
-        "📢 أرسل رسالتك للإذاعة (نص، صورة، فيديو، ملف):\n\nللإلغاء اضغط ❌ إلغاء",
+        TEXTS['broadcast_prompt'],
         reply_markup=get_cancel_keyboard()
     )
-    context.user_data['awaiting_broadcast'] = True
+    context.user_data['state'] = 'broadcast'
 
 async def admin_users(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """User management"""
     await update.message.reply_text(
-        "👥 إدارة المستخدمين\n\n"
-        "• للبحث: أرسل /user [ID]\n"
-        "• للحظر: /ban [ID]\n"
-        "• للفك: /unban [ID]",
+        TEXTS['admin_users'],
         reply_markup=get_admin_keyboard()
     )
 
 async def admin_settings(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Bot settings"""
-    maintenance = db.get_setting('maintenance_mode')
+    maintenance = await run_db(db.get_setting, 'maintenance_mode')
     status = "🔴 مفعل" if maintenance == '1' else "🟢 معطل"
     
     await update.message.reply_text(
@@ -1223,86 +1639,160 @@ async def admin_settings(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def admin_products(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Product management"""
     await update.message.reply_text(
-        "🛍️ إدارة المنتجات\n\n"
-        "• إضافة: /addproduct\n"
-        "• تعديل: /editproduct [ID]\n"
-        "• حذف: /delproduct [ID]",
+        TEXTS['admin_products'],
         reply_markup=get_admin_keyboard()
     )
 
 async def admin_tickets(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Ticket management"""
     await update.message.reply_text(
-        "🎫 إدارة التذاكر\n\n"
-        "لعرض التذاكر المفتوحة: /tickets",
+        TEXTS['admin_tickets'],
         reply_markup=get_admin_keyboard()
     )
 
+@admin_only
 async def admin_add_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Start add admin"""
     await update.message.reply_text(
         "➕ أرسل معرف المستخدم (ID) للترقية:",
         reply_markup=get_cancel_keyboard()
     )
-    context.user_data['awaiting_admin_id'] = True
+    context.user_data['state'] = 'admin_id'
 
+@admin_only
 async def admin_remove_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Start remove admin"""
     await update.message.reply_text(
         "➖ أرسل معرف الأدمن للإزالة:",
         reply_markup=get_cancel_keyboard()
     )
-    context.user_data['removing_admin'] = True
+    context.user_data['state'] = 'remove_admin'
 
 # ==================== INPUT HANDLERS ====================
 
 async def handle_user_input(update: Update, context: ContextTypes.DEFAULT_TYPE, text: str):
     """Handle special inputs"""
-    user_id = update.effective_user.id
-    
-    if context.user_data.get('awaiting_broadcast'):
-        await process_broadcast(update, context, text)
-        context.user_data['awaiting_broadcast'] = False
+    # Input states are one-shot: the state is consumed by the message it awaited
+    handler = STATE_HANDLERS.get(context.user_data.pop('state', None))
+    if handler:
+        await handler(update, context, text)
+
+@admin_only
+async def process_add_admin(update: Update, context: ContextTypes.DEFAULT_TYPE, text: str):
+    """Process add admin"""
+    try:
+        new_admin = int(text)
+    except ValueError:
+        await update.message.reply_text("⚠️ معرف غير صحيح")
+        return
     
-    elif context.user_data.get('awaiting_admin_id'):
-        try:
-            new_admin = int(text)
-            db.add_admin(new_admin, user_id)
-            await update.message.reply_text(
-                f"✅ تمت ترقية المستخدم {new_admin}",
-                reply_markup=get_admin_keyboard()
-            )
-        except:
-            await update.message.reply_text("⚠️ معرف غير صحيح")
-        context.user_data['awaiting_admin_id'] = False
+    await run_db(db.add_admin, new_admin, update.effective_user.id)
+    await update.message.reply_text(
+        f"✅ تمت ترقية المستخدم {new_admin}",
+        reply_markup=get_admin_keyboard()
+    )
+
+@admin_only
+async def process_remove_admin(update: Update, context: ContextTypes.DEFAULT_TYPE, text: str):
+    """Process remove admin"""
+    try:
+        admin_id = int(text)
+    except ValueError:
+        await update.message.reply_text("⚠️ معرف غير صحيح")
+        return
     
-    elif context.user_data.get('creating_ticket'):
-        ticket_id = db.create_ticket(user_id, "دعم فني", text)
-        await update.message.reply_text(
-            f"✅ تم إنشاء تذكرة #{ticket_id}",
-            reply_markup=get_support_keyboard()
-        )
-        context.user_data['creating_ticket'] = False
+    await run_db(db.remove_admin, admin_id)
+    await update.message.reply_text(
+        f"✅ تمت إزالة الأدمن {admin_id}",
+        reply_markup=get_admin_keyboard()
+    )
+
+async def process_ticket(update: Update, context: ContextTypes.DEFAULT_TYPE, text: str):
+    """Process new support ticket"""
+    ticket_id = await run_db(db.create_ticket, update.effective_user.id, "دعم فني", text)
+    await update.message.reply_text(
+        f"✅ تم إنشاء تذكرة #{ticket_id}",
+        reply_markup=get_support_keyboard()
+    )
 
+@admin_only
 async def process_broadcast(update: Update, context: ContextTypes.DEFAULT_TYPE, text: str):
     """Process broadcast"""
-    users = db.get_all_users(limit=5000)
-    sent = 0
+    message = f"📢 إذاعة:\n\n{text}"
     
     status_msg = await update.message.reply_text("⏳ جاري الإرسال...")
     
-    for user in users:
+    # Send in the background: PTB handles updates one at a time, so awaiting
+    # the broadcast here would hold up every other user until it finished
+    context.application.create_task(
+        run_broadcast(context.bot, status_msg, message),
+        update=update
+    )
+
+async def run_broadcast(bot: Bot, status_msg: Message, message: str):
+    """Send a broadcast to every user, reporting progress on status_msg"""
+    # Workers pull recipients from a queue and share one token bucket,
+    # so sends overlap while staying under Telegram's rate limit
+    recipients = asyncio.Queue(maxsize=BROADCAST_WORKERS * 2)
+    bucket = TokenBucket(BROADCAST_RATE_LIMIT)
+    sent = 0
+    processed = 0
+    
+    async def produce():
+        # Stream ids from the database so sending starts after the first batch
+        batches = db.iter_user_id_batches()
         try:
-            await context.bot.send_message(
-                chat_id=user['user_id'],
-                text=f"📢 إذاعة:\n\n{text}"
-            )
-            sent += 1
-            await asyncio.sleep(0.05)
-        except:
-            pass
+            while True:
+                batch = await run_db(next, batches, None)
+                if batch is None:
+                    break
+                for chat_id in batch:
+                    await recipients.put(chat_id)
+        finally:
+            # Workers only stop on a sentinel, so send them even if reading failed
+            for _ in range(BROADCAST_WORKERS):
+                await recipients.put(None)
+    
+    async def worker():
+        nonlocal sent, processed
+        while True:
+            chat_id = await recipients.get()
+            if chat_id is None:
+                return
+            for _ in range(BROADCAST_MAX_RETRIES):
+                await bucket.acquire()
+                try:
+                    await bot.send_message(chat_id=chat_id, text=message)
+                    sent += 1
+                    break
+                except RetryAfter as e:
+                    bucket.pause(e.retry_after)
+                except TelegramError:
+                    break
+                except Exception:
+                    # One bad recipient must not stop this worker draining the queue
+                    logger.exception("Broadcast to %s failed", chat_id)
+                    break
+            processed += 1
+            if processed % BROADCAST_PROGRESS_EVERY == 0:
+                try:
+                    await status_msg.edit_text(f"⏳ جاري الإرسال... {processed}")
+                except TelegramError:
+                    pass
+    
+    results = await asyncio.gather(
+        produce(),
+        *(worker() for _ in range(BROADCAST_WORKERS)),
+        return_exceptions=True
+    )
+    errors = [r for r in results if isinstance(r, Exception)]
+    for error in errors:
+        logger.error("Broadcast stopped early", exc_info=error)
     
-    await status_msg.edit_text(f"✅ تم الإرسال لـ {sent} مستخدم")
+    if errors:
+        await status_msg.edit_text(f"⚠️ توقف الإرسال بعد {sent} مستخدم")
+    else:
+        await status_msg.edit_text(f"✅ تم الإرسال لـ {sent} مستخدم")
 
 async def cancel_operation(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Cancel current operation"""
@@ -1318,58 +1808,150 @@ async def create_ticket_start(update: Update, context: ContextTypes.DEFAULT_TYPE
         "📝 اكتب رسالتك للدعم الفني:",
         reply_markup=get_cancel_keyboard()
     )
-    context.user_data['creating_ticket'] = True
+    context.user_data['state'] = 'ticket'
 
 async def show_my_tickets(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Show user's tickets"""
     user_id = update.effective_user.id
-    tickets = db.get_user_tickets(user_id)
+    tickets = await run_db(db.get_user_tickets, user_id)
     
     if not tickets:
         await update.message.reply_text("📭 ليس لديك تذاكر")
         return
     
-    text = "📋 تذاكرك:\n\n"
-    for t in tickets:
-        status = "🔴 مفتوحة" if t['status'] == 'open' else "✅ مغلقة"
-        text += f"#{t['ticket_id']}: {t['subject']} - {status}\n"
+    text = "📋 تذاكرك:\n\n" + "".join(
+        f"#{t['ticket_id']}: {t['subject']} - {'🔴 مفتوحة' if t['status'] == 'open' else '✅ مغلقة'}\n"
+        for t in tickets
+    )
     
     await update.message.reply_text(text)
 
+# ==================== MESSAGE ROUTES ====================
+
+# Reply keyboard button text -> handler, looked up once per message
+MENU_HANDLERS = {
+    "👤 حسابي": show_profile,
+    "🛒 المتجر": show_shop,
+    "💰 المحفظة": show_wallet,
+    "🎮 الألعاب والترفيه": show_games,
+    "📢 الأخبار": show_news,
+    "🔗 الإحالات": show_referral,
+    "⚙️ الإعدادات": show_settings,
+    "📞 الدعم الفني": show_support,
+    "❓ المساعدة": show_help,
+    "🔐 لوحة تحكم الأدمن": show_admin_panel,
+    "🔙 العودة للقائمة الرئيسية": back_to_main,
+    
+    # Admin commands
+    "📊 الإحصائيات": admin_stats,
+    "👥 إدارة المستخدمين": admin_users,
+    "📢 إذاعة": admin_broadcast_start,
+    "⚙️ إعدادات البوت": admin_settings,
+    "🛍️ إدارة المنتجات": admin_products,
+    "🎫 التذاكر": admin_tickets,
+    "➕ إضافة أدمن": admin_add_start,
+    "➖ إزالة أدمن": admin_remove_start,
+    
+    # Shop categories
+    "🎮 منتجات رقمية": functools.partial(show_category, category="digital"),
+    "👕 ملابس وأزياء": functools.partial(show_category, category="clothing"),
+    "📚 كتب ومراجع": functools.partial(show_category, category="books"),
+    "🎁 هدايا واكسسوارات": functools.partial(show_category, category="gifts"),
+    
+    # Games
+    "🎲 لعبة النرد": play_dice,
+    "🎯 لعبة السهم": play_dart,
+    "🎰 آلة الحظ": play_slots,
+    "❓ تحدي المعرفة": play_trivia,
+    "🏆 المتصدرين": show_leaderboard,
+    "🎁 مكافآت يومية": claim_daily,
+    
+    # Support
+    "📝 إنشاء تذكرة جديدة": create_ticket_start,
+    "📋 عرض تذاكري السابقة": show_my_tickets,
+    "❌ إلغاء": cancel_operation,
+}
+
+# Inline button callback data is "<prefix>:<payload>"; button_handler
+# dispatches on the prefix
+CALLBACK_ROUTES = {
+    'trivia': trivia_answer,
+}
+
+# Free-text input handlers, keyed by context.user_data['state']
+STATE_HANDLERS = {
+    'broadcast': process_broadcast,
+    'admin_id': process_add_admin,
+    'remove_admin': process_remove_admin,
+    'ticket': process_ticket,
+}
+
+# ==================== BACKGROUND JOBS ====================
+
+async def flush_activity_job(context: ContextTypes.DEFAULT_TYPE):
+    """Write buffered user activity to the database"""
+    await run_db(db.flush_activity)
+
+async def flush_points_job(context: ContextTypes.DEFAULT_TYPE):
+    """Write buffered points awards to the database"""
+    await run_db(db.flush_points)
+
+async def flush_pending_writes(application: Application):
+    """Flush buffered writes on shutdown"""
+    await run_db(db.flush_points)
+    await run_db(db.flush_activity)
+
 # ==================== MAIN ====================
 
 def main():
     """Start bot"""
-    application = Application.builder().token(BOT_TOKEN).build()
+    application = (
+        Application.builder()
+        .token(BOT_TOKEN)
+        .connection_pool_size(TELEGRAM_POOL_SIZE)
+        .pool_timeout(30)
+        .connect_timeout(10)
+        .read_timeout(20)
+        .write_timeout(20)
+        .post_shutdown(flush_pending_writes)
+        .build()
+    )
     
     # Handlers
     application.add_handler(CommandHandler("start", start))
     application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_message))
     application.add_handler(CallbackQueryHandler(button_handler))
     
+    # Jobs
+    if application.job_queue is None:
+        raise SystemExit(
+            'JobQueue is unavailable: install it with pip install "python-telegram-bot[job-queue]"'
+        )
+    application.job_queue.run_repeating(
+        flush_activity_job,
+        interval=ACTIVITY_FLUSH_INTERVAL,
+        first=ACTIVITY_FLUSH_INTERVAL
+    )
+    application.job_queue.run_repeating(
+        flush_points_job,
+        interval=POINTS_FLUSH_INTERVAL,
+        first=POINTS_FLUSH_INTERVAL
+    )
+    
     print("🤖 Bot is running with Arabic Reply Keyboard...")
     application.run_polling(allowed_updates=Update.ALL_TYPES)
 
 async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handle inline button callbacks"""
     query = update.callback_query
-    await query.answer()
-    
-    data = query.data
     
-    if data.startswith('trivia_'):
-        parts = data.split('_')
-        selected = int(parts[1])
-        correct = int(parts[2])
-        points = int(parts[3])
-        
-        if selected == correct:
-            db.add_points(update.effective_user.id, points)
-            text = f"✅ إجابة صحيحة! ربحت {points} نقطة"
-        else:
-            text = "❌ إجابة خاطئة! حاول مرة أخرى"
-        
-        await query.edit_message_text(text)
+    prefix, _, payload = query.data.partition(':')
+    handler = CALLBACK_ROUTES.get(prefix)
+    if handler:
+        # Acknowledge the press while the handler edits the message
+        await asyncio.gather(query.answer(), handler(update, context, payload))
+    else:
+        await query.answer()
 
 if __name__ == "__main__":
     main()